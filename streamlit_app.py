@@ -10,14 +10,15 @@ Then concatenate the flattened inputs. Output has no live form fields.
 
 from __future__ import annotations
 
-import hashlib
-import io
+import os
 import re
-import uuid
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime
 from typing import List, Optional
 
+import blake3
 import fitz
 import streamlit as st
 from streamlit_sortables import sort_items
@@ -43,11 +44,10 @@ st.markdown(
 # --------- state ------------------------------------------------------------
 
 
-@dataclass
+@dataclass(slots=True)
 class PDFEntry:
-    id: str
     name: str
-    data: bytes
+    path: str  # upload spilled to a temp file — session state holds metadata only
     checksum: str
     pages: int
     size_bytes: int
@@ -61,22 +61,67 @@ def _init_state() -> None:
     ss.setdefault("last_output", None)
 
 
+_SIZE_UNITS = ("B", "KB", "MB", "GB")
+
+
+def _human_size(num_bytes: int) -> str:
+    """Format a byte count without looping over units: bit_length picks the unit."""
+    idx = 0 if num_bytes < 1024 else min((num_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{num_bytes / (1 << (10 * idx)):.1f} {_SIZE_UNITS[idx]}"
+
+
 def _label(entry: PDFEntry) -> str:
-    kb = entry.size_bytes / 1024
-    size = f"{kb:.0f} KB" if kb < 1024 else f"{kb/1024:.1f} MB"
-    return f"{entry.name}  ·  {entry.pages} pages  ·  {size}"
+    return f"{entry.name}  ·  {entry.pages} pages  ·  {_human_size(entry.size_bytes)}"
+
 
+def _discard_entries(entries: List[PDFEntry]) -> None:
+    for e in entries:
+        try:
+            os.unlink(e.path)
+        except OSError:
+            pass
 
-def _entry_from_label(label: str) -> Optional[PDFEntry]:
-    for f in st.session_state.files:
-        if _label(f) == label:
-            return f
-    return None
+
+def _labels_for(files: List[PDFEntry]) -> List[str]:
+    """Unique labels for the current file list, rebuilt only when it changes.
+
+    Reruns triggered by unrelated widgets reuse the cached list instead of
+    re-formatting every entry. Distinct files can format to the same label
+    (same name, pages, and rounded size), so repeats get a counter suffix —
+    label-keyed widgets like sort_items need labels to identify one entry.
+    """
+    sig = tuple(f.checksum for f in files)
+    cached = st.session_state.get("_labels_cache")
+    if cached is None or cached[0] != sig:
+        labels = [_label(f) for f in files]
+        counts: dict = {}
+        for i, lbl in enumerate(labels):
+            n = counts.get(lbl, 0) + 1
+            counts[lbl] = n
+            if n > 1:
+                labels[i] = f"{lbl}  ·  ({n})"
+        cached = (sig, labels)
+        st.session_state["_labels_cache"] = cached
+    return cached[1]
 
 
 # --------- file ingest ------------------------------------------------------
 
 
+def _stream_checksum(uploaded) -> str:
+    """Hash an upload in 1 MiB chunks — dedup only, not a signature.
+
+    Avoids materializing ``getvalue()`` just to hash: duplicates are
+    rejected without ever holding a second full copy of the file.
+    """
+    h = blake3.blake3()
+    uploaded.seek(0)
+    while chunk := uploaded.read(1 << 20):
+        h.update(chunk)
+    uploaded.seek(0)
+    return h.hexdigest()
+
+
 _SIG_RE = re.compile(r"/FT\s*/Sig\b")
 
 
@@ -94,66 +139,149 @@ def _has_cryptographic_sig(doc: fitz.Document) -> bool:
 
 def _ingest(uploads) -> None:
     existing = {f.checksum for f in st.session_state.files}
-    new_uploads = [u for u in uploads if hashlib.sha1(u.getvalue()).hexdigest() not in existing]
+    # (size, name) pre-check: re-selecting an already-ingested batch in the
+    # uploader is common, and this skips even the hash read for those.
+    seen_sizename = {(f.size_bytes, f.name) for f in st.session_state.files}
+    new_uploads = []
+    for u in uploads:
+        if (u.size, u.name) in seen_sizename:
+            continue
+        csum = _stream_checksum(u)
+        if csum not in existing:
+            new_uploads.append((u, csum))
+            existing.add(csum)
     if not new_uploads:
         return
 
+    skipped: List[str] = []
     with st.status(f"Parsing {len(new_uploads)} file(s)...", expanded=False) as status:
-        for i, up in enumerate(new_uploads, 1):
+        for i, (up, csum) in enumerate(new_uploads, 1):
             status.update(label=f"Parsing {i} of {len(new_uploads)}: {up.name}")
             data = up.getvalue()
-            csum = hashlib.sha1(data).hexdigest()
             try:
                 with fitz.open(stream=data, filetype="pdf") as d:
-                    pages = len(d)
+                    pages = d.page_count
                     has_sig = _has_cryptographic_sig(d)
             except Exception as exc:
-                st.warning(f"Skipping **{up.name}** — not a valid PDF ({exc}).")
+                skipped.append(f"**{up.name}** ({exc})")
                 continue
+            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+            tmp.write(data)
+            tmp.close()
             st.session_state.files.append(
                 PDFEntry(
-                    id=str(uuid.uuid4()),
                     name=up.name,
-                    data=data,
+                    path=tmp.name,
                     checksum=csum,
                     pages=pages,
                     size_bytes=len(data),
                     has_sig=has_sig,
                 )
             )
-            existing.add(csum)
         status.update(label=f"Parsed {len(new_uploads)} file(s)", state="complete")
+    if skipped:
+        st.warning("Skipped — not valid PDFs: " + ", ".join(skipped))
 
 
 # --------- merge ------------------------------------------------------------
 
 
-def _repair_and_bake(entry: PDFEntry, combined: FullRepairReport) -> bytes:
-    """Repair, flatten, and clean one PDF. Returns the flattened bytes."""
-    with fitz.open(stream=entry.data, filetype="pdf") as src:
+# Flattened result per input file, keyed by content checksum. Module-level so
+# it survives Streamlit reruns; bounded so long sessions don't pin old bytes.
+_FLAT_CACHE: dict = {}
+_FLAT_CACHE_MAX = 32
+
+
+def _flat_cache_put(checksum: str, value: tuple[bytes, FullRepairReport]) -> None:
+    if len(_FLAT_CACHE) >= _FLAT_CACHE_MAX:
+        _FLAT_CACHE.pop(next(iter(_FLAT_CACHE)))
+    _FLAT_CACHE[checksum] = value
+
+
+def _needs_flatten(doc: fitz.Document) -> bool:
+    """True if the document has anything to repair or bake.
+
+    Checks AcroForm fields as well as page annotations — orphaned widgets
+    (the damage repair_document fixes) are absent from page /Annots but
+    still reachable from the form tree.
+    """
+    if doc.is_form_pdf:
+        return True
+    for page in doc:
+        if page.first_annot is not None or page.first_widget is not None:
+            return True
+    return False
+
+
+def _repair_and_bake(entry: PDFEntry) -> tuple[bytes, FullRepairReport]:
+    """Repair, flatten, and clean one PDF. Returns (flattened bytes, report)."""
+    with fitz.open(entry.path) as src:
+        if not _needs_flatten(src):
+            with open(entry.path, "rb") as f:
+                return f.read(), FullRepairReport(relink=RelinkReport(), fonts=FontFixReport())
+
         report = repair_document(src)
-        combined.relink.relinked += report.relink.relinked
-        combined.relink.skipped_no_page += report.relink.skipped_no_page
-        combined.relink.details.extend(report.relink.details)
-        combined.fonts.streams_patched += report.fonts.streams_patched
-        combined.fonts.fonts_retargeted += report.fonts.fonts_retargeted
-        combined.fonts.dr_retargeted += report.fonts.dr_retargeted
 
         src.bake()
         for page in src:
             page.clean_contents()
 
-        return src.tobytes(deflate=True, garbage=3, clean=True)
+        # Intermediate bytes are reparsed immediately by insert_pdf; skip
+        # recompressing image/font payloads (already compressed at source)
+        # and leave final compression to the output save.
+        return (
+            src.tobytes(
+                deflate=True, deflate_images=False, deflate_fonts=False, garbage=3, clean=True
+            ),
+            report,
+        )
 
 
-def _merge(entries: List[PDFEntry], progress) -> tuple[bytes, FullRepairReport]:
+def _absorb(combined: FullRepairReport, report: FullRepairReport) -> None:
+    combined.relink.relinked += report.relink.relinked
+    combined.relink.skipped_no_page += report.relink.skipped_no_page
+    combined.relink.details.extend(report.relink.details)
+    combined.fonts.streams_patched += report.fonts.streams_patched
+    combined.fonts.fonts_retargeted += report.fonts.fonts_retargeted
+    combined.fonts.dr_retargeted += report.fonts.dr_retargeted
+    combined.bboxes.bboxes_fixed += report.bboxes.bboxes_fixed
+
+
+def _merge(entries: List[PDFEntry], progress) -> tuple[str, FullRepairReport]:
+    """Flatten and concatenate entries. Returns (output file path, report)."""
     combined = FullRepairReport(relink=RelinkReport(), fonts=FontFixReport())
     flat_bytes: List[bytes] = []
 
+    # Damaged inputs make MuPDF chatty; drop warnings accumulated by earlier
+    # merges so the buffer doesn't grow for the life of the process.
+    fitz.TOOLS.mupdf_warnings(reset=True)
+
+    # Each file gets its own Document, and bake/clean run inside MuPDF's C
+    # code with the GIL released — so files flatten in parallel safely.
     total = len(entries)
-    for i, entry in enumerate(entries, 1):
-        progress.update(label=f"Repairing & flattening {i} of {total}: {entry.name}")
-        flat_bytes.append(_repair_and_bake(entry, combined))
+    with ThreadPoolExecutor(max_workers=min(total, os.cpu_count() or 1)) as pool:
+        # Snapshot cache hits up front: _FLAT_CACHE is shared across sessions
+        # and eviction (our own puts included) must not drop an entry this
+        # merge still needs mid-loop.
+        hits = {}
+        for e in entries:
+            cached = _FLAT_CACHE.get(e.checksum)
+            if cached is not None:
+                hits[e.checksum] = cached
+        pending = {
+            e.checksum: pool.submit(_repair_and_bake, e)
+            for e in entries
+            if e.checksum not in hits
+        }
+        for i, entry in enumerate(entries, 1):
+            progress.update(label=f"Repairing & flattening {i} of {total}: {entry.name}")
+            cached = hits.get(entry.checksum)
+            if cached is None:
+                cached = pending[entry.checksum].result()
+                _flat_cache_put(entry.checksum, cached)
+            data, report = cached
+            _absorb(combined, report)
+            flat_bytes.append(data)
 
     progress.update(label="Merging flattened pages...")
     out_doc = fitz.open()
@@ -161,9 +289,16 @@ def _merge(entries: List[PDFEntry], progress) -> tuple[bytes, FullRepairReport]:
         with fitz.open(stream=b, filetype="pdf") as src:
             out_doc.insert_pdf(src)
 
-    out = out_doc.tobytes(deflate=True, garbage=3)
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    tmp.close()
+    out_doc.save(tmp.name, deflate=True, garbage=4, clean=True)
     out_doc.close()
-    return out, combined
+
+    # MuPDF's object store caches parsed objects across documents; empty it
+    # so RSS doesn't stay at merge peak for the life of the server process.
+    fitz.TOOLS.store_shrink(100)
+
+    return tmp.name, combined
 
 
 # --------- UI ---------------------------------------------------------------
@@ -210,10 +345,11 @@ def _render_file_list() -> None:
             "Flattening keeps the visible signature but breaks crypto validation."
         )
 
-    labels = [_label(f) for f in files]
+    labels = _labels_for(files)
     ordered = sort_items(labels, direction="vertical", key="file_order")
     if ordered != labels:
-        new_files = [_entry_from_label(lbl) for lbl in ordered]
+        by_label = dict(zip(labels, files))
+        new_files = [by_label.get(lbl) for lbl in ordered]
         if all(new_files):
             st.session_state.files = new_files
             st.rerun()
@@ -221,37 +357,62 @@ def _render_file_list() -> None:
     st.caption("Drag to reorder. Pages are merged top → bottom.")
 
     with st.expander("Remove individual files"):
-        for f in list(files):
-            c1, c2 = st.columns([4, 1])
-            c1.write(_label(f))
-            if c2.button("Remove", key=f"rm_{f.id}", use_container_width=True):
-                st.session_state.files = [x for x in files if x.id != f.id]
-                st.rerun()
+        # Options are checksums — the entry identity — so removal survives
+        # label collisions and reorders between selection and click.
+        label_by_checksum = dict(zip((f.checksum for f in files), labels))
+        to_remove = st.multiselect(
+            "Files to remove",
+            list(label_by_checksum),
+            format_func=label_by_checksum.get,
+            label_visibility="collapsed",
+        )
+        if to_remove and st.button("Remove selected", use_container_width=True):
+            gone = set(to_remove)
+            _discard_entries([f for f in files if f.checksum in gone])
+            st.session_state.files = [f for f in files if f.checksum not in gone]
+            st.rerun()
 
     if st.button("Clear all", use_container_width=True):
+        _discard_entries(st.session_state.files)
         st.session_state.files = []
         st.session_state.uploader_salt += 1
-        st.session_state.last_output = None
+        _discard_output()
         st.rerun()
 
 
+def _discard_output() -> None:
+    out = st.session_state.last_output
+    if out:
+        try:
+            os.unlink(out["path"])
+        except OSError:
+            pass
+    st.session_state.last_output = None
+
+
 def _render_action() -> None:
     if not st.session_state.files:
         return
     if st.button("Repair, flatten & merge", type="primary", use_container_width=True):
+        key = tuple(f.checksum for f in st.session_state.files)
+        out = st.session_state.last_output
+        if out and out.get("key") == key and os.path.exists(out["path"]):
+            return  # same files, same order — the last output is still current
         with st.status("Starting...", expanded=False) as progress:
             try:
-                data, report = _merge(st.session_state.files, progress)
-                ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+                path, report = _merge(st.session_state.files, progress)
+                ts = time.strftime("%Y%m%d-%H%M%S")
+                _discard_output()
                 st.session_state.last_output = {
-                    "bytes": data,
+                    "path": path,
                     "name": f"merged-{ts}.pdf",
                     "report": report,
+                    "key": key,
                 }
                 progress.update(label="Done", state="complete")
             except Exception as exc:
                 progress.update(label=f"Failed: {exc}", state="error")
-                st.session_state.last_output = None
+                _discard_output()
 
 
 def _render_output() -> None:
@@ -259,7 +420,11 @@ def _render_output() -> None:
     if not out:
         return
 
-    size_mb = len(out["bytes"]) / (1024 * 1024)
+    try:
+        size_mb = os.path.getsize(out["path"]) / (1024 * 1024)
+    except OSError:
+        st.session_state.last_output = None
+        return
     st.success(f"Done · {size_mb:.2f} MB · non-modifiable")
 
     report: Optional[FullRepairReport] = out.get("report")
@@ -269,14 +434,15 @@ def _render_output() -> None:
         c2.metric("Appearance streams patched", report.fonts.streams_patched)
         c3.metric("Font refs retargeted", report.fonts.fonts_retargeted + report.fonts.dr_retargeted)
 
-    st.download_button(
-        label=f"Download {out['name']}",
-        data=out["bytes"],
-        file_name=out["name"],
-        mime="application/pdf",
-        type="primary",
-        use_container_width=True,
-    )
+    with open(out["path"], "rb") as f:
+        st.download_button(
+            label=f"Download {out['name']}",
+            data=f,
+            file_name=out["name"],
+            mime="application/pdf",
+            type="primary",
+            use_container_width=True,
+        )
 
 
 def main() -> None: